@@ -1,18 +1,22 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from enum import Enum
+import gzip
 import http.client
 import json
 import os
+import re
 import shutil
 import subprocess
-import uuid
 
 API_HOSTNAME = "code.golf"
 API_ENDPOINT_EXPORT = "/golfer/export"
 
 AUTHORIZATION_KEY = "__Host-session"
 
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE)
+
 LANGUAGE_NAMES_EXTENSIONS = {
     "fish": ["><>", "fish"],
     "assembly": ["Assembly", "asm"],
@@ -68,7 +72,9 @@ LANGUAGE_NAMES_EXTENSIONS = {
     "zig": ["Zig", "zig"]
 }
 
-DEFAULT_IGNORE_LIST = [".git", ".gitignore", ".github", "README.md", "LICENSE"]
+LANGUAGE_EXTENSIONS = {language_code: extension for language_code, (_, extension) in LANGUAGE_NAMES_EXTENSIONS.items()}
+
+DEFAULT_IGNORE_SET = frozenset({".git", ".gitignore", ".github", "README.md", "LICENSE"})
 
 
 class FileStructure(Enum):
@@ -82,6 +88,22 @@ class FileStructure(Enum):
     HOLE_EXTENSION = "he"
 
 
+class FileKind(Enum):
+    MISSING = "missing"
+    FILE = "file"
+    DIRECTORY = "directory"
+    # Anything else, e.g. a socket or a dangling symlink
+    OTHER = "other"
+
+
+SOLUTION_PATH_FORMATS = {
+    FileStructure.LANGUAGE_HOLE_EXTENSION: lambda hole_code, language_code, category_suffix, extension: f"{language_code}/{hole_code}{category_suffix}.{extension}",
+    FileStructure.HOLE_LANGUAGE_EXTENSION: lambda hole_code, language_code, category_suffix, extension: f"{hole_code}/{language_code}{category_suffix}.{extension}",
+    FileStructure.HOLE_SOLUTION_EXTENSION: lambda hole_code, language_code, category_suffix, extension: f"{hole_code}/solution{category_suffix}.{extension}",
+    FileStructure.HOLE_EXTENSION: lambda hole_code, language_code, category_suffix, extension: f"{hole_code}{category_suffix}.{extension}",
+}
+
+
 def input_yes_no(prompt):
     while True:
         value = input(f"{prompt} [y/n]: ").lower()
@@ -93,26 +115,23 @@ def input_yes_no(prompt):
 
 
 def is_valid_uuid(value):
-    try:
-        uuid.UUID(str(value))
-        return True
-    except ValueError:
-        return False
+    return UUID_PATTERN.fullmatch(str(value)) is not None
+
+
+def get_file_kind(entry):
+    if entry is None:
+        return FileKind.MISSING
+    elif entry.is_dir():
+        return FileKind.DIRECTORY
+    elif entry.is_file():
+        return FileKind.FILE
+    else:
+        return FileKind.OTHER
 
 
 def get_solution_path(file_structure, hole_code, language_code, category):
-    _, extension = LANGUAGE_NAMES_EXTENSIONS[language_code]
     category_suffix = f"-{category}" if category else ""
-    if file_structure == FileStructure.LANGUAGE_HOLE_EXTENSION:
-        return f"{language_code}/{hole_code}{category_suffix}.{extension}"
-    elif file_structure == FileStructure.HOLE_LANGUAGE_EXTENSION:
-        return f"{hole_code}/{language_code}{category_suffix}.{extension}"
-    elif file_structure == FileStructure.HOLE_SOLUTION_EXTENSION:
-        return f"{hole_code}/solution{category_suffix}.{extension}"
-    elif file_structure == FileStructure.HOLE_EXTENSION:
-        return f"{hole_code}{category_suffix}.{extension}"
-    else:
-        raise Exception
+    return SOLUTION_PATH_FORMATS[file_structure](hole_code, language_code, category_suffix, LANGUAGE_EXTENSIONS[language_code])
 
 
 def export_data(authorization):
@@ -121,41 +140,53 @@ def export_data(authorization):
     connection = http.client.HTTPSConnection(API_HOSTNAME)
     headers = {
         "Cookie": f"{AUTHORIZATION_KEY}={authorization}",
+        "Accept-Encoding": "gzip",
     }
-    connection.request("GET", API_ENDPOINT_EXPORT, headers=headers)
-    response = connection.getresponse()
-    if response.status == 200:
-        response_data = response.read().decode("utf-8")
-        return json.loads(response_data)
-    else:
-        print(f"Request failed with status code {response.status}")
+    try:
+        connection.request("GET", API_ENDPOINT_EXPORT, headers=headers)
+        response = connection.getresponse()
+        if response.status == 200:
+            # The standard library has no streaming JSON parser: the whole body is still read, decoded and then parsed
+            if response.getheader("Content-Encoding") == "gzip":
+                return json.load(gzip.GzipFile(fileobj=response))
+            return json.load(response)
+        else:
+            print(f"Request failed with status code {response.status}")
+    finally:
+        connection.close()
 
 
-def compute_final_state(file_structure, only_category, collapse_same_categories, data):
-    solutions = data["solutions"]
-    codes_per_solution = {}
-    for solution in solutions:
-        hole_code = solution["hole"]
-        language_code = solution["lang"]
-        code = solution["code"]
-        key = (hole_code, language_code)
-        if key not in codes_per_solution:
-            codes_per_solution[key] = set()
-        codes_per_solution[key].add(code)
-    state = {}
-    for solution in solutions:
+def compute_final_state(file_structure, only_category, collapse_same_categories, solutions):
+    first_codes = {}  # First code seen for each (hole, language)
+    not_unique = set()  # (hole, language) pairs that have at least two distinct codes
+    latest = {}  # Latest solution for each (hole, language, category), along with its position
+    for index, solution in enumerate(solutions):
         hole_code = solution["hole"]
         language_code = solution["lang"]
         category = solution["scoring"]
         date = solution["submitted"]
         code = solution["code"]
-        unique = len(codes_per_solution[(hole_code, language_code)]) == 1
+        key = (hole_code, language_code)
+        if key not in not_unique:
+            first_code = first_codes.setdefault(key, code)
+            if first_code != code:
+                not_unique.add(key)
         if only_category is not None and only_category != category:
             continue
+        latest_key = (hole_code, language_code, category)
+        if latest_key in latest and date <= latest[latest_key][1]["date"]:
+            continue
+        # Encoded once here, the content is then compared and written as bytes
+        latest[latest_key] = (index, {"content": code.encode("utf-8"), "date": date})
+    # Uniqueness is only known once all the solutions have been seen, hence paths are resolved afterward
+    # Entries are visited in their original order so that ties on the date are broken as before
+    state = {}
+    for (hole_code, language_code, category), (_, entry) in sorted(latest.items(), key=lambda item: item[1][0]):
+        unique = (hole_code, language_code) not in not_unique
         path = get_solution_path(file_structure, hole_code, language_code, None if collapse_same_categories and unique and not only_category else category)
-        if path in state and date <= state[path]["date"]:
+        if path in state and entry["date"] <= state[path]["date"]:
             continue
-        state[path] = {"content": code, "date": date}
+        state[path] = entry
     return state
 
 
@@ -165,65 +196,130 @@ def compute_changes(state, should_delete, output):
     files_to_create = []
     directories_to_create = []
 
-    def walk_recursive(current_directory, children):
-        current_directory_files = os.listdir(current_directory) if os.path.exists(current_directory) else []
-
+    # Tree of the needed files: directories are dicts, files are their encoded content
+    tree = {}
+    for path, entry in state.items():
+        *directories, name = path.split("/")
+        node = tree
+        for directory in directories:
+            node = node.setdefault(directory, {})
+            if not isinstance(node, dict):
+                raise Exception(f"{path} conflicts with another solution")
+        if name in node:
+            raise Exception(f"{path} conflicts with another solution")
+        node[name] = entry["content"]
+
+    def scan_directory(current_directory, needed, current_directory_exists):
+        directory_to_delete = []
+        directory_files_to_update = []
+        directory_files_to_compare = []
+        directory_files_to_create = []
+        directory_directories_to_create = []
         explore = []
 
-        needed = dict()
-        for child in children:
-            head = child["parts"][0]
-            if head not in needed:
-                needed[head] = []
-            needed[head].append(child)
-        all_files = sorted(set(current_directory_files).union(set(key for key in needed)))
+        # Whether the directory exists is already known from the scan of its parent
+        if current_directory_exists:
+            with os.scandir(current_directory) as iterator:
+                current_directory_entries = {entry.name: entry for entry in iterator}
+        else:
+            current_directory_entries = {}
+
+        all_files = sorted(set(current_directory_entries).union(needed))
 
+        # Same result as joining every file with the directory, but the separator logic only runs once
+        directory_prefix = os.path.join(current_directory, "")
         for file in all_files:
-            file_path = os.path.join(current_directory, file)
-            exists = os.path.exists(file_path)
-            file_exists = os.path.isfile(file_path)
-            directory_exists = os.path.isdir(file_path)
-            is_needed = file in needed
-            if is_needed:
-                files_data = needed[file]
-                is_directory = all(len(file_data["parts"]) > 1 for file_data in files_data)
-                if is_directory:
-                    if not exists:
-                        directories_to_create.append(file_path)
-                    elif not directory_exists:
-                        if not should_delete:
-                            raise Exception(f"{file_path} exists and is not a directory")
-                        to_delete.append(file_path)
-                        directories_to_create.append(file_path)
-                    explore.append(file)
-                else:
-                    assert len(files_data) == 1
-                    content = files_data[0]["content"]
-                    entry = {"path": file_path, "content": content}
-                    if not exists:
-                        files_to_create.append(entry)
-                    else:
-                        if file_exists:
-                            with open(file_path, "r") as f:
-                                current_content = f.read()
-                                if current_content != content:
-                                    files_to_update.append(entry)
-                        else:
-                            if not should_delete:
-                                raise Exception(f"{file_path} exists and is not a file")
-                            to_delete.append(file_path)
-                            files_to_create.append(entry)
+            file_path = directory_prefix + file
+            current_entry = current_directory_entries.get(file)
+            kind = get_file_kind(current_entry)
+            if file not in needed:
+                if should_delete and file not in DEFAULT_IGNORE_SET:  # Can be improved
+                    directory_to_delete.append(file_path)
+                continue
+            child = needed[file]
+            needed_kind = FileKind.DIRECTORY if isinstance(child, dict) else FileKind.FILE
+            if kind != FileKind.MISSING and kind != needed_kind:
+                if not should_delete:
+                    raise Exception(f"{file_path} exists and is not a {needed_kind.value}")
+                directory_to_delete.append(file_path)
+            if needed_kind == FileKind.DIRECTORY:
+                if kind != FileKind.DIRECTORY:
+                    directory_directories_to_create.append(file_path)
+                explore.append((file_path, child, kind == FileKind.DIRECTORY))
             else:
-                if should_delete and file not in DEFAULT_IGNORE_LIST:  # Can be improved
-                    to_delete.append(file_path)
-
-        for file in explore:
-            walk_recursive(os.path.join(current_directory, file), [{**child, "parts": child["parts"][1:]} for child in needed[file]])
+                entry = {"path": file_path, "content": child}
+                if kind != FileKind.FILE:
+                    directory_files_to_create.append(entry)
+                else:
+                    # Files of a different size are necessarily outdated, no need to read them
+                    # The others are kept in place, and dropped later if they turn out to be up to date
+                    directory_files_to_update.append(entry)
+                    if current_entry.stat().st_size == len(child):
+                        directory_files_to_compare.append(entry)
+
+        return directory_to_delete, directory_files_to_update, directory_files_to_compare, directory_files_to_create, directory_directories_to_create, explore
+
+    def is_outdated(entry):
+        with open(entry["path"], "rb") as f:
+            return f.read() != entry["content"]
+
+    files_to_compare = []
+    with ThreadPoolExecutor() as executor:
+        # The directories of a same level are independent, so they are scanned concurrently
+        results = {}
+        level = [(output, tree, os.path.isdir(output))]
+        while level:
+            next_level = []
+            for (current_directory, _, _), result in zip(level, executor.map(lambda args: scan_directory(*args), level)):
+                results[current_directory] = result
+                next_level.extend(result[-1])
+            level = next_level
+
+        # The results are then merged depth-first, so that the changes are listed in the order of a recursive walk
+        stack = [output]
+        while stack:
+            directory_to_delete, directory_files_to_update, directory_files_to_compare, directory_files_to_create, directory_directories_to_create, explore = results.pop(stack.pop())
+            to_delete.extend(directory_to_delete)
+            files_to_update.extend(directory_files_to_update)
+            files_to_compare.extend(directory_files_to_compare)
+            files_to_create.extend(directory_files_to_create)
+            directories_to_create.extend(directory_directories_to_create)
+            # Reversed so that the subdirectories are popped in order
+            stack.extend(reversed([file_path for file_path, _, _ in explore]))
+
+        # The existing files are read concurrently, and compared as bytes to avoid decoding them
+        outdated = executor.map(is_outdated, files_to_compare)
+        up_to_date = {id(entry) for entry, is_entry_outdated in zip(files_to_compare, outdated) if not is_entry_outdated}
+        files_to_update[:] = [entry for entry in files_to_update if id(entry) not in up_to_date]
 
-    walk_recursive(output, [{"parts": path.split("/"), "content": state[path]["content"]} for path in state])
     return {"to_delete": to_delete, "files_to_update": files_to_update, "files_to_create": files_to_create, "directories_to_create": directories_to_create}
 
 
+def write_file(path, content, dir_fd=None):
+    # Bypasses the text layer: the encoded content is written with as few calls as possible
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666, dir_fd=dir_fd)
+    try:
+        remaining = memoryview(content)
+        while remaining:
+            remaining = remaining[os.write(fd, remaining):]
+    finally:
+        os.close(fd)
+
+
+def write_directory_files(directory, files_data):
+    if os.open not in os.supports_dir_fd:
+        for file_data in files_data:
+            write_file(file_data["path"], file_data["content"])
+        return
+    # The files are opened relative to their directory, so that only their name has to be resolved
+    dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for file_data in files_data:
+            write_file(os.path.basename(file_data["path"]), file_data["content"], dir_fd=dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
 def update_files(changes):
     to_delete = changes["to_delete"]
     files_to_update = changes["files_to_update"]
@@ -235,18 +331,33 @@ def update_files(changes):
             shutil.rmtree(file)  # Beware, can be dangerous if misused
         else:
             os.remove(file)
-    for file in directories_to_create:
-        os.mkdir(file)
-    for file_data in files_to_update:
-        with open(file_data["path"], "w") as f:
-            f.write(file_data["content"])
-    for file_data in files_to_create:
-        with open(file_data["path"], "w") as f:
-            f.write(file_data["content"])
-
-
-def update_git(output):
-    subprocess.run(["git", "add", "-A"], check=True, cwd=output)
+    with ThreadPoolExecutor() as executor:
+        # Missing parents are created along the way, so the directories can be created in any order
+        list(executor.map(lambda file: os.makedirs(file, exist_ok=True), directories_to_create))
+        # The directories are independent from each other, so their files are written concurrently
+        files_per_directory = {}
+        for file_data in files_to_update + files_to_create:
+            files_per_directory.setdefault(os.path.dirname(file_data["path"]) or os.curdir, []).append(file_data)
+        list(executor.map(lambda item: write_directory_files(*item), files_per_directory.items()))
+
+
+def update_git(output, changes):
+    # Only the changed paths are staged, so that git doesn't have to scan the whole working tree
+    # Files left uncommitted by a previous run (e.g. with --no-git) are therefore not picked up
+    deleted_paths = [os.path.relpath(file, output) for file in changes["to_delete"]]
+    written_paths = [os.path.relpath(file_data["path"], output) for file_data in changes["files_to_update"] + changes["files_to_create"]]
+    if deleted_paths:
+        # Deleted paths may not have been tracked
+        subprocess.run(["git", "--literal-pathspecs", "rm", "-r", "-q", "--cached", "--ignore-unmatch", "--pathspec-from-file=-", "--pathspec-file-nul"], input=b"\0".join(map(os.fsencode, deleted_paths)), check=True, cwd=output)
+    if written_paths:
+        # Like `git add -A`, untracked files matched by a .gitignore are skipped (git add fails on them when given explicitly)
+        result = subprocess.run(["git", "check-ignore", "--stdin", "-z"], input=b"\0".join(map(os.fsencode, written_paths)), stdout=subprocess.PIPE, cwd=output)
+        if result.returncode not in (0, 1):  # 1 means that no path is ignored
+            raise subprocess.CalledProcessError(result.returncode, result.args)
+        ignored_paths = set(os.fsdecode(path) for path in result.stdout.split(b"\0") if path)
+        written_paths = [path for path in written_paths if path not in ignored_paths]
+    if written_paths:
+        subprocess.run(["git", "--literal-pathspecs", "add", "--pathspec-from-file=-", "--pathspec-file-nul"], input=b"\0".join(map(os.fsencode, written_paths)), check=True, cwd=output)
     current_date = datetime.datetime.now().strftime("%Y-%m-%d")
     commit_message = f"Update {current_date}"
     subprocess.run(["git", "commit", "-m", commit_message], check=True, cwd=output)
@@ -261,7 +372,7 @@ def main():
     parser.add_argument("--only-scoring", help="If set, only this scoring metric will be kept", choices=["bytes", "chars"], default=None)
     parser.add_argument("--no-scoring-name", help="Drop the scoring metric if there are no ambiguities", action=argparse.BooleanOptionalAction, default=False)
 
-    parser.add_argument("--no-git", help="Disable version control (files will be modified but not committed)", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument("--no-git", help="Disable version control (files will be modified but not committed, and later runs will only commit the files they change themselves)", action=argparse.BooleanOptionalAction, default=False)
 
     parser.add_argument("--no-delete", help="Disable the deletion of files", action=argparse.BooleanOptionalAction, default=False)
 
@@ -288,7 +399,7 @@ def main():
     print("Exporting data...")
     data = export_data(authorization)
     print("Computing diff...")
-    state = compute_final_state(structure, only_scoring, not no_scoring_name, data)
+    state = compute_final_state(structure, only_scoring, not no_scoring_name, data["solutions"])
     changes = compute_changes(state, not no_delete, output_path)
 
     to_delete = changes["to_delete"]
@@ -318,7 +429,7 @@ def main():
         if not no_git:
             print("Committing changes...")
             if not dry_run:
-                update_git(output_path)
+                update_git(output_path, changes)
 
         print("Done.")
 